@@ -1,7 +1,18 @@
 # src/plugins/hai_turtle_soup/plugin.py
 import os
-import json
-import aiohttp
+import re
+import time
+import uuid
+import logging
+import weakref
+import itertools
+import asyncio
+import random
+import hashlib
+import httpx
+import orjson
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
 from typing import List, Tuple, Type, Optional
 from src.plugin_system import (
     BasePlugin,
@@ -13,9 +24,194 @@ from src.plugin_system import (
 
 PLUGIN_DIR = os.path.dirname(__file__)
 
-# 全局游戏状态存储
+# redis 只在配置了 llm.redis_url 时才需要，未安装时插件仍可用进程内存储运行
+try:
+    from redis.exceptions import RedisError
+except ImportError:
+    RedisError = None
+
+# 读写游戏状态时可能出现的异常；ImportError 表示配置了 Redis 却没有安装 redis
+_STATE_ERRORS = (orjson.JSONDecodeError, ImportError) + ((RedisError,) if RedisError else ())
+
+# 日志的输出方式由宿主程序的 logging 配置决定
+logger = logging.getLogger(__name__)
+
+# Redis 中游戏状态的键与过期时间，过期防止弃局残留
+STATE_KEY = "turtlesoup:state:{}"
+STATE_TTL = 86400
+
+# 每局保留的提问/猜测记录条数，以及整理线索时发给 LLM 的最近条数
+GUESS_HISTORY_SIZE = 30
+CLUE_HISTORY_SIZE = 15
+
+# 跨进程的群锁（SET NX PX）；单条命令的处理时限必须短于锁的过期时间，
+# 否则锁可能在处理中途过期、被其他实例拿走。等待其他实例的锁最多一个过期周期，
+# 足够等正常持有者处理完，持有者崩溃时锁也会在此期间过期
+LOCK_KEY = "turtlesoup:lock:{}"
+LOCK_TTL_MS = 120000
+LOCK_POLL_INTERVAL = 0.1
+LOCK_WAIT_TIMEOUT = LOCK_TTL_MS / 1000
+COMMAND_TIMEOUT = 90
+
+# 只在锁持有者仍是自己时释放
+_UNLOCK_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+# LLM 响应缓存容量与有效期（秒）；只缓存调用方声明 prompt 能完全决定结果的调用
+RESPONSE_CACHE_SIZE = 256
+RESPONSE_CACHE_TTL = 600
+
+# LLM 请求重试：最多尝试次数、可重试的状态码、单次退避上限（秒）
+LLM_MAX_ATTEMPTS = 3
+RETRYABLE_STATUSES = frozenset({429, 500, 502, 503, 504})
+MAX_BACKOFF = 8
+
+# 各类调用的 max_tokens 预算：判定只需一两个字，提示与回答都很短
+GUESS_MAX_TOKENS = 8
+HINT_MAX_TOKENS = 80
+REPLY_MAX_TOKENS = 200
+NEW_GAME_MAX_TOKENS = 800
+
+# 流式输出时攒够这么多字才在句末分段发送，避免刷屏
+STREAM_MIN_SEGMENT = 50
+SENTENCE_ENDINGS = ("。", "！", "？", "\n")
+
+# 插件加载时预热 LLM 连接的超时（秒）
+CONNECTION_PREWARM_TIMEOUT = 5
+
+# 令牌桶最多攒下多少秒的配额，限制突发请求
+RATE_LIMIT_BURST_SECONDS = 10
+
+# 等待预生成提示的最长时间（秒），超时则重新请求
+PREWARM_HINT_TIMEOUT = 5
+
+# /hgt 支持的子命令
+_ACTIONS = ("提示", "问题", "整理线索", "猜谜", "退出", "帮助", "揭秘", "汤面")
+
+_COMMAND_PATTERN = r"^/hgt(?:\s+(?P<action>(?:" + "|".join(_ACTIONS) + r")))(?:\s+(?P<rest>.+))?$"
+
+# 参考例题放在用户消息开头，固定前缀便于服务端复用 prompt 缓存
+_FEWSHOT_EXAMPLES = """可以参考的海龟汤汤面and汤底（仅供参考，可以套模版或者直接搬，但是严格按照输出格式）：
+1.【子的爱】
+汤面：我的父母都不理我，但我还是很爱他们。
+汤底：小时候我是个很听话的孩子，爸爸妈妈经常给我好吃的水果，我吃不完。他们就告诉我喜欢的东西一定要放进冰箱，这样可以保鲜，记得那时候他们工作可辛苦了，经常加班到深夜。没睡过一个好觉。于是我耍了个小聪明，在他们的水里下了安眠药。他们睡得可香了，然后我把他们放进冰箱里，从那以后我每天都会对他们说：爸爸妈妈我爱你们。现在我都六十了，他们还是那么年轻。
+
+2.【舞】
+汤面：我六岁那年，外公去世，我和亲人一起去祭奠，和姐姐玩捉迷藏，然后我对母亲说了句话把她吓昏了过去。
+汤底：我去参加外公的葬礼，同行的还有比我大两岁的姐姐，我和她完捉迷藏我没有找到她没想到她躲在了纸做的房子里，当纸房子被点燃，我看见姐姐在跳舞，我对妈说，妈姐姐在那房子里面跳舞，因为姐姐被烧死了，我一直记得这个事。
+
+3.【插进来】
+汤面：他迅速的插进来，又迅速的拔出去。反反复复，我流血了。他满头大汗，露出了笑容。“啊，好舒服”
+汤底：他是实习护士，在给我打针，针头打进血管里面会回血，因此说明成功了。流汗是因为反反复复了好几次，让人紧张。
+
+4.【无罪】
+汤面：“她是自愿的！”尸体无暴力痕迹，凶手被判无罪。“我是无罪的！”尸体有暴力痕迹，凶手也被判无罪。
+汤底：第一幕：女儿为救他人（如器官移植）自愿牺牲，所以“自愿”且无暴力痕迹，他人无罪。第二幕：父亲无法接受女儿死亡真相，杀害了被判无罪的人，但法医发现此人所受暴力伤害与父亲行为不符（或父亲伪造证据），真相是女儿死于意外，父亲为报复误杀他人，故父亲也称自己“无罪”，但法律上仍有罪。
+"""
+
+_NEW_GAME_PROMPT = _FEWSHOT_EXAMPLES + """
+你是一个专业的海龟汤故事生成器。
+请生成一个新颖的海龟汤题目（汤面）以及对应的答案（汤底），不要使用经典题材（比如：餐馆、飞机、婚礼、海龟等）。
+汤面要求：
+1. 题目简短，最好 25~50 字。
+2. 题目必须是海龟汤风格的推理谜题，包含一个看似矛盾或奇怪的情境。
+3. 不要在题目里包含答案。
+4. 可以包含猎奇和恐怖元素(如杀人之类的)。
+5. 题目结尾应该留有悬念，让人好奇真相。
+6. 生成的题目应该是原创的，不要复制已有例子。
+汤底要求：合理解释汤面，可以蕴含恐怖元素（比如杀人之类的），讲究逻辑和一些现实，不要解释。150字以内。
+
+输出格式：严格输出一个 JSON 对象，形如 {"question": "汤面", "answer": "汤底"}，不要输出其他内容。
+汤面和汤底中需要引号时使用中文引号“”或「」，不要使用英文双引号 "（如确需使用必须写成 \\"）。
+Respond with ONLY JSON.
+"""
+
+# 解析生成结果的兜底正则，用于模型输出不是严格 JSON 的情况
+_QA_FALLBACK = re.compile(r'"question"\s*:\s*"((?:[^"\\]|\\.)+)".*"answer"\s*:\s*"((?:[^"\\]|\\.)+)"', re.S)
+
+
+def _parse_question_answer(text):
+    """从模型输出中解析 (汤面, 汤底)，失败时返回空字符串"""
+    start, end = text.find("{"), text.rfind("}")
+    try:
+        data = orjson.loads(text[start:end + 1])
+        return str(data.get("question", "")).strip(), str(data.get("answer", "")).strip()
+    except (ValueError, AttributeError):
+        match = _QA_FALLBACK.search(text)
+        if match:
+            return _unescape_json_string(match.group(1)), _unescape_json_string(match.group(2))
+        return "", ""
+
+
+def _unescape_json_string(raw):
+    """还原兜底正则取出的 JSON 字符串内容（如 \\" 和 \\n），无法解析时原样返回"""
+    try:
+        return orjson.loads(f'"{raw}"').strip()
+    except orjson.JSONDecodeError:
+        return raw.strip()
+
+
+def _retry_delay(attempt, retry_after=None):
+    """优先遵循 Retry-After（秒数形式），否则指数退避并加少量抖动"""
+    if retry_after:
+        try:
+            return min(MAX_BACKOFF, max(0.0, float(retry_after)))
+        except ValueError:
+            pass
+    return min(MAX_BACKOFF, 0.5 * 2 ** attempt) + random.random() * 0.25
+
+
+def _guess_history(state):
+    """取出有界的 guess_history；从 Redis 读回的 list 会在这里转成 deque"""
+    history = state.get("guess_history")
+    if not isinstance(history, deque):
+        history = state["guess_history"] = deque(history or (), maxlen=GUESS_HISTORY_SIZE)
+    return history
+
+
+def _json_default(obj):
+    if isinstance(obj, deque):
+        return list(obj)
+    raise TypeError
+
+
+class _TokenBucket:
+    """按每分钟速率补充令牌的异步令牌桶，等待者按到达顺序放行"""
+
+    def __init__(self, rate_per_min):
+        self.rate_per_min = rate_per_min
+        self._rate = rate_per_min / 60
+        self._capacity = max(1.0, self._rate * RATE_LIMIT_BURST_SECONDS)
+        self._tokens = self._capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self._rate)
+
+
+class GroupBusyError(Exception):
+    """等待群锁超时，说明同一群的上一条命令仍在处理"""
+
+
+# 未配置 Redis 时使用的进程内游戏状态存储
 game_states = {}  # {group_id: {"current_question": "", "current_answer": "", "hints_used": 0, "game_active": False, "guess_history": [], "game_over": False}}
 
+# 每个群一把锁，串行处理同一群的命令；不再使用的锁会被自动回收
+_group_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+
 @register_plugin
 class HaiTurtleSoupPlugin(BasePlugin):
     plugin_name = "turtlesoup_plugin"
@@ -25,7 +221,7 @@ class HaiTurtleSoupPlugin(BasePlugin):
     enable_plugin = True
 
     dependencies = []
-    python_dependencies = ["aiohttp"]
+    python_dependencies = ["httpx[http2]", "redis", "orjson"]
 
     config_file_name = "config.toml"
     config_section_descriptions = {
@@ -45,6 +241,11 @@ class HaiTurtleSoupPlugin(BasePlugin):
                 default="1.6.0",
                 description="配置文件版本"
             ),
+            "max_input_length": ConfigField(
+                type=int,
+                default=500,
+                description="提问与猜谜内容的最大字数，超出直接拒绝"
+            ),
         },
         "llm": {
             "api_url": ConfigField(
@@ -66,10 +267,61 @@ class HaiTurtleSoupPlugin(BasePlugin):
                 type=float,
                 default=0.7,
                 description="文本生成随机性"
+            ),
+            "connection_limit": ConfigField(
+                type=int,
+                default=100,
+                description="HTTP 连接池最大连接数"
+            ),
+            "max_keepalive_connections": ConfigField(
+                type=int,
+                default=50,
+                description="保持空闲复用的最大连接数"
+            ),
+            "keepalive_timeout": ConfigField(
+                type=int,
+                default=60,
+                description="空闲连接保活时间（秒）"
+            ),
+            "redis_url": ConfigField(
+                type=str,
+                default="",
+                description="游戏状态存储的 Redis 地址（如 redis://localhost:6379/0），留空则保存在进程内存中"
+            ),
+            "rate_per_minute": ConfigField(
+                type=int,
+                default=60,
+                description="每分钟最多发出的 LLM 请求数（含重试），0 表示不限制"
+            ),
+            "stream": ConfigField(
+                type=bool,
+                default=True,
+                description="提问与整理线索时是否流式输出，边生成边发送"
             )
         }
     }
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # 加载时若已在事件循环中，则后台预先建立到 LLM 的连接
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._prewarm_task = None
+        else:
+            self._prewarm_task = loop.create_task(self._prewarm_connection())
+
+    async def _prewarm_connection(self):
+        """尽力而为地完成 TCP+TLS 握手，把首次调用的握手开销移出用户请求"""
+        api_url = self.get_config("llm.api_url", "")
+        if not api_url:
+            return
+        try:
+            client = await HaiTurtleSoupCommand._get_client(self.get_config)
+            await client.head(api_url, timeout=CONNECTION_PREWARM_TIMEOUT)
+        except Exception as e:
+            logger.debug("预热 LLM 连接失败: %s", e)
+
     def get_plugin_components(self) -> List[Tuple[ComponentInfo, Type]]:
         return [
             (HaiTurtleSoupCommand.get_command_info(), HaiTurtleSoupCommand),
@@ -78,7 +330,7 @@ class HaiTurtleSoupPlugin(BasePlugin):
 class HaiTurtleSoupCommand(BaseCommand):
     command_name = "HaiTurtleSoupCommand"
     command_description = "生成海龟汤题目或互动 /hgt [问题|提示|整理线索|汤面|猜谜|退出|帮助|揭秘]"
-    command_pattern = r"^/hgt(?:\s+(?P<action>(?:提示|问题|整理线索|猜谜|退出|帮助|揭秘|汤面)))(?:\s+(?P<rest>.+))?$"
+    command_pattern = _COMMAND_PATTERN
     command_help = (
     "海龟汤游戏:\n"
     "/hgt 问题(生成题目)\n"
@@ -105,10 +357,43 @@ class HaiTurtleSoupCommand(BaseCommand):
     ]
     intercept_message = True
 
+    # 所有命令实例共享的 HTTP/2 客户端，单个连接上多路复用并发请求，避免每次调用都重新握手
+    _client: Optional[httpx.AsyncClient] = None
+    _client_loop: Optional[asyncio.AbstractEventLoop] = None
+
+    # 本进程共享的出站请求限速器，速率配置变化时重建
+    _bucket: Optional[_TokenBucket] = None
+
+    # 请求头与请求体骨架在配置不变时保持不变，按 (api_key, model, temperature) 缓存
+    _request_key: Optional[tuple] = None
+    _headers: dict = {}
+    _payload_base: dict = {}
+
+    # 相同 prompt 的 LLM 响应缓存: key -> (过期时间, 回复)
+    _response_cache: "OrderedDict[tuple, Tuple[float, str]]" = OrderedDict()
+
+    # 开局时预先生成的第一条提示: group_id -> (题目, Task)，仅存于本进程
+    _prewarm_hint_tasks: dict = {}
+
+    # 按地址缓存的 Redis 客户端（内部自带连接池）
+    _redis_clients: dict = {}
+
+    # action -> (处理方法名, 是否需要附加输入)；需要输入但未提供时按新游戏处理
+    _HANDLERS = {
+        "问题": ("_handle_question", True),
+        "提示": ("_handle_hint", False),
+        "整理线索": ("_handle_clues", False),
+        "猜谜": ("_handle_guess", True),
+        "揭秘": ("_handle_reveal", False),
+        "退出": ("_handle_exit", False),
+        "汤面": ("_handle_show", False),
+        "帮助": ("_handle_help", False),
+    }
+
     async def execute(self):
-        matched_groups = self.matched_groups or {}
-        action = str(matched_groups.get("action") or "").strip()
-        rest_input = str(matched_groups.get("rest") or "").strip()
+        get_group = (self.matched_groups or {}).get
+        action = (get_group("action") or "").strip()
+        rest_input = (get_group("rest") or "").strip()
 
         chat_stream = getattr(self, 'chat_stream', None) or getattr(getattr(self, 'message', None), 'chat_stream', None)
         if chat_stream is None:
@@ -138,57 +423,116 @@ class HaiTurtleSoupCommand(BaseCommand):
         else:
             group_id = getattr(getattr(chat_stream, 'user_info', None), 'user_id', "unknown")
 
-        # 初始化游戏状态
-        game_state = game_states.get(group_id, {})
-        if group_id not in game_states:
-            game_states[group_id] = game_state
-
         # --- 分支逻辑 ---
-        if action == "问题" and rest_input:
-            return await self._handle_question(group_id, rest_input, api_url, api_key, model, temperature)
-        elif action == "提示":
-            return await self._handle_hint(group_id, api_url, api_key, model, temperature)
-        elif action == "整理线索":
-            return await self._handle_clues(group_id, api_url, api_key, model, temperature)
-        elif action == "汤面":
-            state = game_states.get(group_id)
-            if not state.get("game_active"):
-                await self.send_text("❌ 当前没有进行中的游戏")
-                return False, "无游戏", True
-            await self.send_text(f"🍲 当前海龟汤题目:\n{state.get('current_question')}")
-            return True, "查看汤面", True
-        elif action == "猜谜" and rest_input:
-            return await self._handle_guess(group_id, rest_input, api_url, api_key, model, temperature)
-        elif action == "揭秘":
-            # 用户请求直接查看答案
-            if not game_state.get("game_active", False):
-                await self.send_text("❌ 当前没有正在进行的游戏。请先使用 /hgt 生成题目。")
-                return False, "无游戏", True
-
-            answer = game_state.get("current_answer", "无答案")
-            await self.send_text(f"🔓 当前海龟汤答案是:\n{answer}\n游戏结束。")
-            
-            # 标记游戏结束
-            game_state["game_active"] = False
-            game_state["game_over"] = True
-            game_states[group_id] = game_state  # 保存更新后的状态
-
-            return True, "已揭秘", True
-        elif action == "退出":
-            return await self._handle_exit(group_id)
-        elif action == "帮助":
-            await self.send_text(self.command_help)
-            return True, "显示帮助", True
-        else:
-            return await self._start_new_game(group_id, api_url, api_key, model, temperature, stream_id)
+        # 处理方法只原地修改 state，统一在结束时保存
+        try:
+            async with self._group_guard(group_id):
+                state = await self._get_state(group_id)
+                try:
+                    return await asyncio.wait_for(
+                        self._dispatch(action, rest_input, group_id, state, api_url, api_key, model, temperature, stream_id),
+                        COMMAND_TIMEOUT,
+                    )
+                except asyncio.TimeoutError:
+                    await self.send_text("❌ 处理超时，请稍后再试")
+                    return False, "处理超时", True
+                finally:
+                    if state:
+                        await self._set_state(group_id, state)
+        except GroupBusyError:
+            await self.send_text("⏳ 上一条命令仍在处理中，请稍后再试")
+            return False, "群锁等待超时", True
+        except _STATE_ERRORS:
+            logger.exception("游戏状态存储异常 (group_id=%s)", group_id)
+            await self.send_text("❌ 状态存储不可用，请稍后再试")
+            return False, "状态存储异常", True
+
+    async def _dispatch(self, action, rest_input, group_id, state, api_url, api_key, model, temperature, stream_id):
+        entry = self._HANDLERS.get(action)
+        if entry is None or (entry[1] and not rest_input):
+            return await self._start_new_game(group_id, state, api_url, api_key, model, temperature, stream_id)
+        handler_name, needs_input = entry
+
+        handler = getattr(self, handler_name)
+        if needs_input:
+            return await handler(group_id, state, rest_input, api_url, api_key, model, temperature)
+        return await handler(group_id, state, api_url, api_key, model, temperature)
+
+    # --- 游戏状态存取 ---
+    @classmethod
+    def _get_redis(cls, redis_url):
+        client = cls._redis_clients.get(redis_url)
+        if client is None:
+            import redis.asyncio as aioredis
+            client = cls._redis_clients[redis_url] = aioredis.Redis.from_url(redis_url)
+        return client
+
+    @asynccontextmanager
+    async def _group_guard(self, group_id):
+        """同一群的命令排队串行执行；配置了 Redis 时额外持有跨进程锁，等待超时抛出 GroupBusyError"""
+        # 本进程内排队等待即可：持有者的处理时间受 COMMAND_TIMEOUT 限制，不会无限占用
+        async with _group_locks.setdefault(group_id, asyncio.Lock()):
+            redis_url = self.get_config("llm.redis_url", "")
+            if not redis_url:
+                yield
+                return
+
+            client = self._get_redis(redis_url)
+            key = LOCK_KEY.format(group_id)
+            token = uuid.uuid4().hex
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + LOCK_WAIT_TIMEOUT
+            while not await client.set(key, token, nx=True, px=LOCK_TTL_MS):
+                if loop.time() >= deadline:
+                    raise GroupBusyError(group_id)
+                await asyncio.sleep(LOCK_POLL_INTERVAL)
+            try:
+                yield
+            finally:
+                try:
+                    await client.eval(_UNLOCK_SCRIPT, 1, key, token)
+                except RedisError:
+                    # 释放失败时锁会在 LOCK_TTL_MS 后自行过期
+                    logger.warning("释放群锁失败 (group_id=%s)", group_id, exc_info=True)
+
+    async def _get_state(self, group_id) -> dict:
+        redis_url = self.get_config("llm.redis_url", "")
+        if not redis_url:
+            return game_states.setdefault(group_id, {})
+        client = self._get_redis(redis_url)
+        key = STATE_KEY.format(group_id)
+        raw = await client.get(key)
+        try:
+            return orjson.loads(raw) if raw else {}
+        except orjson.JSONDecodeError:
+            # 损坏的状态无法恢复，删除后下一条命令从头开始
+            await client.delete(key)
+            raise
+
+    async def _set_state(self, group_id, state):
+        redis_url = self.get_config("llm.redis_url", "")
+        if not redis_url:
+            game_states[group_id] = state
+            return
+        await self._get_redis(redis_url).set(STATE_KEY.format(group_id), orjson.dumps(state, default=_json_default), ex=STATE_TTL)
 
     # --- 游戏逻辑方法 ---
-    async def _handle_question(self, group_id, question, api_url, api_key, model, temperature):
-        state = game_states.get(group_id)
+    async def _reject_long_input(self, text):
+        """输入超过长度上限时提示用户并返回 True，避免把超长内容发给 LLM"""
+        limit = self.get_config("plugin.max_input_length", 500)
+        if len(text) <= limit:
+            return False
+        await self.send_text(f"❌ 输入过长，请精简 (≤{limit}字)")
+        return True
+
+    async def _handle_question(self, group_id, state, question, api_url, api_key, model, temperature):
+        if await self._reject_long_input(question):
+            return False, "输入过长", True
         if not state.get("game_active"):
-            return await self._start_new_game(group_id, api_url, api_key, model, temperature, None)
+            return await self._start_new_game(group_id, state, api_url, api_key, model, temperature, None)
 
-        state.setdefault("guess_history", []).append({"type": "question", "content": question})
+        _guess_history(state).append({"type": "question", "content": question})
+        self._prewarm_hint(group_id, state, api_url, api_key, model, temperature)
 
         prompt = f"""
 你是一个海龟汤游戏专家。
@@ -197,13 +541,12 @@ class HaiTurtleSoupCommand(BaseCommand):
 用户提问: {question}
 请用简短的回答回应玩家，不要透露答案。
 """
-        llm_response = await self._call_llm_api(prompt, api_url, api_key, model, temperature)
-        reply = llm_response.strip() or "❌ LLM未返回回答"
-        await self.send_text(f"❓ 你问: {question}\n💡 回答: {reply}")
+        await self._reply_with_llm(
+            f"❓ 你问: {question}\n💡 回答: ", prompt, api_url, api_key, model, temperature, REPLY_MAX_TOKENS
+        )
         return True, "问题回答完成", True
 
-    async def _handle_hint(self, group_id, api_url, api_key, model, temperature):
-        state = game_states.get(group_id)
+    async def _handle_hint(self, group_id, state, api_url, api_key, model, temperature):
         if not state.get("game_active"):
             await self.send_text("❌ 当前没有进行中的游戏")
             return False, "无游戏", True
@@ -211,24 +554,23 @@ class HaiTurtleSoupCommand(BaseCommand):
             await self.send_text("💡 提示已用完")
             return False, "提示用尽", True
 
-        prompt = f"""
-你是一个海龟汤游戏专家。
-题目: {state.get('current_question')}
-答案: {state.get('current_answer')}
-请提供一个不直接透露答案的提示。
-"""
-        hint = await self._call_llm_api(prompt, api_url, api_key, model, temperature)
+        hint = await self._take_prewarmed_hint(group_id, state.get('current_question'))
+        if not hint:
+            prompt = self._build_hint_prompt(state.get('current_question'), state.get('current_answer'))
+            hint = await self._call_llm_api(prompt, api_url, api_key, model, temperature, max_tokens=HINT_MAX_TOKENS)
         state["hints_used"] = state.get("hints_used", 0) + 1
-        game_states[group_id] = state
         await self.send_text(f"💡 提示 ({state['hints_used']}/3): {hint.strip()}")
         return True, "提示完成", True
 
-    async def _handle_clues(self, group_id, api_url, api_key, model, temperature):
-        state = game_states.get(group_id)
+    async def _handle_clues(self, group_id, state, api_url, api_key, model, temperature):
         if not state.get("game_active"):
             await self.send_text("❌ 当前没有进行中的游戏")
             return False, "无游戏", True
-        guess_history = "\n".join([item["content"] for item in state.get("guess_history", [])])
+        history = _guess_history(state)
+        guess_history = "\n".join(
+            item["content"] if isinstance(item, dict) else item
+            for item in itertools.islice(history, max(len(history) - CLUE_HISTORY_SIZE, 0), None)
+        )
         prompt = f"""
 你是一个海龟汤游戏专家。
 题目: {state.get('current_question')}
@@ -237,12 +579,12 @@ class HaiTurtleSoupCommand(BaseCommand):
 已有记录:
 {guess_history}
 """
-        clues = await self._call_llm_api(prompt, api_url, api_key, model, temperature)
-        await self.send_text(f"📝 线索整理:\n{clues.strip()}")
+        await self._reply_with_llm("📝 线索整理:\n", prompt, api_url, api_key, model, temperature, REPLY_MAX_TOKENS)
         return True, "线索整理完成", True
 
-    async def _handle_guess(self, group_id, guess, api_url, api_key, model, temperature):
-        state = game_states.get(group_id)
+    async def _handle_guess(self, group_id, state, guess, api_url, api_key, model, temperature):
+        if await self._reject_long_input(guess):
+            return False, "输入过长", True
         if not state.get("game_active"):
             await self.send_text("❌ 当前没有进行中的游戏")
             return False, "无游戏", True
@@ -257,104 +599,287 @@ class HaiTurtleSoupCommand(BaseCommand):
 用户猜测: {guess}
 请仅回答 是/不是/无关。
 """
-        llm_response = (await self._call_llm_api(prompt, api_url, api_key, model, temperature)).strip().lower()
-        state.setdefault("guess_history", []).append(guess)
-        game_states[group_id] = state
-
+        # 是/不是/无关 的判定结果是确定的，可以直接复用缓存
+        llm_response = (await self._call_llm_api(
+            prompt, api_url, api_key, model, temperature,
+            max_tokens=GUESS_MAX_TOKENS, stop=["\n"], cacheable=True,
+        )).strip().lower()
+        _guess_history(state).append(guess)
         if llm_response == "是":
             state["game_over"] = True
-            game_states[group_id] = state
+            self._discard_prewarmed_hint(group_id)
             await self.send_text(f"🎉 猜对了！答案: {state.get('current_answer')}")
         elif llm_response == "不是":
             await self.send_text(f"❌ 猜错了！提示次数: {state.get('hints_used',0)}/3")
         else:
             await self.send_text("❓ 你的回答与题目无关")
+        self._prewarm_hint(group_id, state, api_url, api_key, model, temperature)
         return True, "猜谜完成", True
 
-    async def _handle_exit(self, group_id):
-        game_states[group_id] = {"current_question":"","current_answer":"","hints_used":0,"game_active":False,"guess_history":[],"game_over":False}
-        await self.send_text("🛑 游戏已退出")
-        return True, "退出游戏", True
+    @staticmethod
+    def _build_hint_prompt(question, answer):
+        return f"""
+你是一个海龟汤游戏专家。
+题目: {question}
+答案: {answer}
+请提供一个不直接透露答案的提示。
+"""
 
-    async def _start_new_game(self, group_id, api_url, api_key, model, temperature, stream_id):
-        state = game_states.get(group_id, {})
+    def _prewarm_hint(self, group_id, state, api_url, api_key, model, temperature):
+        """玩家开始互动后在后台预先生成第一条提示，请求提示时可直接使用；没人互动的局不花这次调用"""
+        question = state.get("current_question")
+        if state.get("hints_used", 0) or state.get("game_over"):
+            return
+        entry = self._prewarm_hint_tasks.get(group_id)
+        if entry is not None and entry[0] == question:
+            return
+        self._discard_prewarmed_hint(group_id)
+        prompt = self._build_hint_prompt(question, state.get("current_answer"))
+        task = asyncio.create_task(
+            self._call_llm_api(prompt, api_url, api_key, model, temperature, max_tokens=HINT_MAX_TOKENS)
+        )
+        self._prewarm_hint_tasks[group_id] = (question, task)
+
+    async def _take_prewarmed_hint(self, group_id, question):
+        entry = self._prewarm_hint_tasks.pop(group_id, None)
+        if entry is None:
+            return ""
+        prewarm_question, task = entry
+        if prewarm_question != question:
+            task.cancel()
+            return ""
+        try:
+            return await asyncio.wait_for(task, PREWARM_HINT_TIMEOUT)
+        except asyncio.TimeoutError:
+            return ""
 
-    # 如果已经有题目在进行中，就不允许再出题
-        if state.get("game_active", False) and not state.get("game_over", False):
-            await self.send_text("⚠️ 当前已经有题目在进行中，请先使用 /hgt 揭秘 或 /hgt 退出 再开始新题。")
-            return False, "已有进行中的游戏", True
+    def _discard_prewarmed_hint(self, group_id):
+        entry = self._prewarm_hint_tasks.pop(group_id, None)
+        if entry is not None:
+            entry[1].cancel()
 
-        # 生成题目
-        prompt_question = """
-你是一个专业的海龟汤故事生成器。
-请生成一个新颖的海龟汤题目，不要使用经典题材（比如：餐馆、飞机、婚礼、海龟等）。
-要求：
-1. 题目简短，最好 25~50 字。
-2. 题目必须是海龟汤风格的推理谜题，包含一个看似矛盾或奇怪的情境。
-3. 不要在题目里包含答案。
-4. 可以包含猎奇和恐怖元素(如杀人之类的)。
-5. 题目结尾应该留有悬念，让人好奇真相。
-6. 生成的题目应该是原创的，不要复制已有例子。
+    async def _handle_reveal(self, group_id, state, *_):
+        # 用户请求直接查看答案
+        if not state.get("game_active", False):
+            await self.send_text("❌ 当前没有正在进行的游戏。请先使用 /hgt 生成题目。")
+            return False, "无游戏", True
 
-请生成一个海龟汤题目。
+        answer = state.get("current_answer", "无答案")
+        await self.send_text(f"🔓 当前海龟汤答案是:\n{answer}\n游戏结束。")
 
-可以参考的海龟汤汤面and汤底（仅供参考，可以套模版或者直接搬，但是严格按照输出格式，仅输出汤面）：
-1.【子的爱】
-汤面：我的父母都不理我，但我还是很爱他们。
-汤底：小时候我是个很听话的孩子，爸爸妈妈经常给我好吃的水果，我吃不完。他们就告诉我喜欢的东西一定要放进冰箱，这样可以保鲜，记得那时候他们工作可辛苦了，经常加班到深夜。没睡过一个好觉。于是我耍了个小聪明，在他们的水里下了安眠药。他们睡得可香了，然后我把他们放进冰箱里，从那以后我每天都会对他们说：爸爸妈妈我爱你们。现在我都六十了，他们还是那么年轻。
+        # 标记游戏结束
+        self._discard_prewarmed_hint(group_id)
+        state["game_active"] = False
+        state["game_over"] = True
 
-2.【舞】
-汤面：我六岁那年，外公去世，我和亲人一起去祭奠，和姐姐玩捉迷藏，然后我对母亲说了句话把她吓昏了过去。
-汤底：我去参加外公的葬礼，同行的还有比我大两岁的姐姐，我和她完捉迷藏我没有找到她没想到她躲在了纸做的房子里，当纸房子被点燃，我看见姐姐在跳舞，我对妈说，妈姐姐在那房子里面跳舞，因为姐姐被烧死了，我一直记得这个事。
+        return True, "已揭秘", True
 
-3.【插进来】
-汤面：他迅速的插进来，又迅速的拔出去。反反复复，我流血了。他满头大汗，露出了笑容。“啊，好舒服”
-汤底：他是护士，在给我打针，针头打进血管里面会回血，因此说明成功了。流汗是因为反反复复了好几次。
+    async def _handle_show(self, group_id, state, *_):
+        if not state.get("game_active"):
+            await self.send_text("❌ 当前没有进行中的游戏")
+            return False, "无游戏", True
+        await self.send_text(f"🍲 当前海龟汤题目:\n{state.get('current_question')}")
+        return True, "查看汤面", True
 
-4.【无罪】
-汤面："她是自愿的！"尸体无暴力痕迹，凶手被判无罪。"我是无罪的！"尸体有暴力痕迹，凶手也被判无罪。
-汤底：第一幕：女儿为救他人（如器官移植）自愿牺牲，所以"自愿"且无暴力痕迹，他人无罪。第二幕：父亲无法接受女儿死亡真相，杀害了被判无罪的人，但法医发现此人所受暴力伤害与父亲行为不符（或父亲伪造证据），真相是女儿死于意外，父亲为报复误杀他人，故父亲也称自己"无罪"，但法律上仍有罪。
-"""
-        question = (await self._call_llm_api(prompt_question, api_url, api_key, model, temperature)).strip()
-        # 生成答案
-        prompt_answer = f"""
-题目: {question}
-你是一个专业的海龟汤故事专家。请生成对应的合理的答案，可以蕴含恐怖元素（比如杀人之类的），讲究逻辑和一些现实，不要解释。150字以内。
+    async def _handle_help(self, group_id, state, *_):
+        await self.send_text(self.command_help)
+        return True, "显示帮助", True
 
-可以参考的海龟汤汤面and汤底（仅供参考，可以套模版或者直接搬，但是严格按照输出格式，仅输出汤底）：
-1.【子的爱】
-汤面：我的父母都不理我，但我还是很爱他们。
-汤底：小时候我是个很听话的孩子，爸爸妈妈经常给我好吃的水果，我吃不完。他们就告诉我喜欢的东西一定要放进冰箱，这样可以保鲜，记得那时候他们工作可辛苦了，经常加班到深夜。没睡过一个好觉。于是我耍了个小聪明，在他们的水里下了安眠药。他们睡得可香了，然后我把他们放进冰箱里，从那以后我每天都会对他们说：爸爸妈妈我爱你们。现在我都六十了，他们还是那么年轻。
+    async def _handle_exit(self, group_id, state, *_):
+        self._discard_prewarmed_hint(group_id)
+        state.clear()
+        state.update({"current_question":"","current_answer":"","hints_used":0,"game_active":False,"guess_history":[],"game_over":False})
+        await self.send_text("🛑 游戏已退出")
+        return True, "退出游戏", True
 
-2.【舞】
-汤面：我六岁那年，外公去世，我和亲人一起去祭奠，和姐姐玩捉迷藏，然后我对母亲说了句话把她吓昏了过去。
-汤底：我去参加外公的葬礼，同行的还有比我大两岁的姐姐，我和她完捉迷藏我没有找到她没想到她躲在了纸做的房子里，当纸房子被点燃，我看见姐姐在跳舞，我对妈说，妈姐姐在那房子里面跳舞，因为姐姐被烧死了，我一直记得这个事。
+    async def _start_new_game(self, group_id, state, api_url, api_key, model, temperature, stream_id):
 
-3.【插进来】
-汤面：他迅速的插进来，又迅速的拔出去。反反复复，我流血了。他满头大汗，露出了笑容。"啊，好舒服"
-汤底：他是实习护士，在给我打针，针头打进血管里面会回血，因此说明成功了。流汗是因为反反复复了好几次，让人紧张。
+    # 如果已经有题目在进行中，就不允许再出题
+        if state.get("game_active", False) and not state.get("game_over", False):
+            await self.send_text("⚠️ 当前已经有题目在进行中，请先使用 /hgt 揭秘 或 /hgt 退出 再开始新题。")
+            return False, "已有进行中的游戏", True
 
-4.【无罪】
-汤面："她是自愿的！"尸体无暴力痕迹，凶手被判无罪。"我是无罪的！"尸体有暴力痕迹，凶手也被判无罪。
-汤底：第一幕：女儿为救他人（如器官移植）自愿牺牲，所以"自愿"且无暴力痕迹，他人无罪。第二幕：父亲无法接受女儿死亡真相，杀害了被判无罪的人，但法医发现此人所受暴力伤害与父亲行为不符（或父亲伪造证据），真相是女儿死于意外，父亲为报复误杀他人，故父亲也称自己"无罪"，但法律上仍有罪。
-"""
-        answer = (await self._call_llm_api(prompt_answer, api_url, api_key, model, temperature)).strip()
-        game_states[group_id] = {"current_question": question, "current_answer": answer, "hints_used":0, "game_active":True, "guess_history":[], "game_over":False}
+        # 一次调用同时生成汤面与汤底，避免两次串行请求
+        question, answer = _parse_question_answer(
+            await self._call_llm_api(_NEW_GAME_PROMPT, api_url, api_key, model, temperature, max_tokens=NEW_GAME_MAX_TOKENS)
+        )
+        if not question or not answer:
+            await self.send_text("❌ 题目生成失败，请稍后再试")
+            return False, "题目生成失败", True
+        state.clear()
+        state.update({"current_question": question, "current_answer": answer, "hints_used":0, "game_active":True, "guess_history":[], "game_over":False})
+        self._discard_prewarmed_hint(group_id)
         await self.send_text(f"🤔 海龟汤题目:\n{question}\n💡 提示次数: 0/3\n💡 使用 /hgt 问题 <问题> 提问，/hgt 提示 获取提示，/hgt 猜谜 <答案> 猜测汤底")
         return True, "新题目生成完成", True
 
-    async def _call_llm_api(self, prompt, api_url, api_key, model, temperature):
-        headers = {"Content-Type": "application/json","Authorization": f"Bearer {api_key}"}
-        payload = {"model": model,"messages":[{"role":"system","content":"你是一个专业海龟汤故事生成器和解释者。"},{"role":"user","content":prompt}],"temperature":temperature,"max_tokens":500,"stream":False}
+    @classmethod
+    async def _get_client(cls, get_config) -> httpx.AsyncClient:
+        """懒加载共享客户端；客户端关闭或事件循环变化时重新创建"""
+        client = cls._client
+        loop = asyncio.get_running_loop()
+        if client is not None and not client.is_closed and cls._client_loop is loop:
+            return client
+
+        limits = httpx.Limits(
+            max_connections=get_config("llm.connection_limit", 100),
+            max_keepalive_connections=get_config("llm.max_keepalive_connections", 50),
+            keepalive_expiry=get_config("llm.keepalive_timeout", 60),
+        )
+        cls._client = httpx.AsyncClient(http2=True, limits=limits, timeout=httpx.Timeout(30.0))
+        cls._client_loop = loop
+        return cls._client
+
+    @classmethod
+    def _build_request(cls, prompt, api_key, model, temperature):
+        """返回 (headers, payload)，配置变化时才重建缓存的骨架"""
+        key = (api_key, model, temperature)
+        if cls._request_key != key:
+            cls._headers = {"Content-Type": "application/json", "Authorization": f"Bearer {api_key}"}
+            cls._payload_base = {
+                "model": model,
+                "messages": [{"role": "system", "content": "你是一个专业海龟汤故事生成器和解释者。"}, None],
+                "temperature": temperature,
+                "max_tokens": 500,
+                "stream": False,
+            }
+            cls._request_key = key
+
+        payload = cls._payload_base.copy()
+        payload["messages"] = [cls._payload_base["messages"][0], {"role": "user", "content": prompt}]
+        return cls._headers, payload
+
+    async def _call_llm_api(self, prompt, api_url, api_key, model, temperature, max_tokens=500, stop=None, cacheable=False):
+        """调用 LLM；仅 cacheable=True 时复用相同 prompt 的缓存结果"""
+        if not cacheable:
+            return await self._request_llm(prompt, api_url, api_key, model, temperature, max_tokens, stop)
+
+        cache = self._response_cache
+        key = (hashlib.blake2b(prompt.encode(), digest_size=16).hexdigest(), model, round(temperature * 10), max_tokens)
+        loop = asyncio.get_running_loop()
+        cached = cache.get(key)
+        if cached is not None and cached[0] > loop.time():
+            cache.move_to_end(key)
+            return cached[1]
+
+        reply = await self._request_llm(prompt, api_url, api_key, model, temperature, max_tokens, stop)
+        if reply:
+            cache[key] = (loop.time() + RESPONSE_CACHE_TTL, reply)
+            cache.move_to_end(key)
+            while len(cache) > RESPONSE_CACHE_SIZE:
+                cache.popitem(last=False)
+        return reply
+
+    @classmethod
+    def _get_bucket(cls, rate_per_min) -> Optional[_TokenBucket]:
+        if rate_per_min <= 0:
+            return None
+        if cls._bucket is None or cls._bucket.rate_per_min != rate_per_min:
+            cls._bucket = _TokenBucket(rate_per_min)
+        return cls._bucket
+
+    @asynccontextmanager
+    async def _open_llm_response(self, api_url, headers, body):
+        """发送请求，遇到可重试错误时退避重试；成功时产出 200 响应，否则产出 None"""
+        for attempt in range(LLM_MAX_ATTEMPTS):
+            retry_after = None
+            bucket = self._get_bucket(self.get_config("llm.rate_per_minute", 60))
+            if bucket is not None:
+                await bucket.acquire()
+            try:
+                client = await self._get_client(self.get_config)
+                request = client.build_request("POST", api_url, headers=headers, content=body)
+                resp = await client.send(request, stream=True)
+            except httpx.TransportError as e:
+                logger.warning("LLM API连接异常 (第%d次): %s", attempt + 1, e)
+            else:
+                if resp.status_code == 200:
+                    try:
+                        yield resp
+                    finally:
+                        await resp.aclose()
+                    return
+                retry_after = resp.headers.get("Retry-After")
+                await resp.aclose()
+                logger.warning("LLM API返回状态码 %d (第%d次)", resp.status_code, attempt + 1)
+                if resp.status_code not in RETRYABLE_STATUSES:
+                    break
+
+            if attempt + 1 < LLM_MAX_ATTEMPTS:
+                await asyncio.sleep(_retry_delay(attempt, retry_after))
+        yield None
+
+    async def _request_llm(self, prompt, api_url, api_key, model, temperature, max_tokens, stop=None):
+        headers, payload = self._build_request(prompt, api_key, model, temperature)
+        payload["max_tokens"] = max_tokens
+        if stop:
+            payload["stop"] = stop
         try:
-            timeout = aiohttp.ClientTimeout(total=30)
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                async with session.post(api_url, headers=headers, json=payload) as resp:
-                    if resp.status == 200:
-                        data = await resp.json()
-                        return data.get("choices",[{}])[0].get("message",{}).get("content","").strip()
-                    else:
-                        return ""
-        except Exception as e:
-            print(f"LLM API异常: {e}")
+            async with self._open_llm_response(api_url, headers, orjson.dumps(payload)) as resp:
+                if resp is None:
+                    return ""
+                data = orjson.loads(await resp.aread())
+            return data["choices"][0]["message"]["content"].strip()
+        except (KeyError, IndexError, TypeError, AttributeError):
+            logger.warning("LLM API响应格式异常")
             return ""
+        except Exception:
+            logger.exception("LLM API异常")
+            return ""
+
+    async def _stream_llm_api(self, prompt, api_url, api_key, model, temperature, on_segment, max_tokens=500):
+        """以 SSE 流式调用 LLM，按句子边界把内容分段交给 on_segment，返回完整回复"""
+        headers, payload = self._build_request(prompt, api_key, model, temperature)
+        payload["max_tokens"] = max_tokens
+        payload["stream"] = True
+        parts = []
+        pending = ""
+        try:
+            async with self._open_llm_response(api_url, headers, orjson.dumps(payload)) as resp:
+                if resp is None:
+                    return ""
+                async for line in resp.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[5:].strip()
+                    if data == "[DONE]":
+                        break
+                    try:
+                        delta = orjson.loads(data)["choices"][0]["delta"].get("content") or ""
+                    except (ValueError, KeyError, IndexError, TypeError):
+                        continue
+                    pending += delta
+                    if len(pending) < STREAM_MIN_SEGMENT:
+                        continue
+                    cut = max(pending.rfind(mark) for mark in SENTENCE_ENDINGS) + 1
+                    if cut:
+                        segment, pending = pending[:cut], pending[cut:]
+                        parts.append(segment)
+                        await on_segment(segment.strip())
+        except Exception:
+            logger.exception("LLM API异常")
+
+        if pending.strip():
+            parts.append(pending)
+            await on_segment(pending.strip())
+        return "".join(parts).strip()
+
+    async def _reply_with_llm(self, header, prompt, api_url, api_key, model, temperature, max_tokens=500):
+        """把 LLM 回复以 header 开头发送给用户；启用流式时边生成边发送"""
+        if not self.get_config("llm.stream", True):
+            reply = (await self._call_llm_api(prompt, api_url, api_key, model, temperature, max_tokens=max_tokens)).strip()
+            await self.send_text(header + (reply or "❌ LLM未返回回答"))
+            return reply
+
+        sent = False
+
+        async def send_segment(segment):
+            nonlocal sent
+            if segment:
+                await self.send_text(segment if sent else header + segment)
+                sent = True
+
+        reply = await self._stream_llm_api(prompt, api_url, api_key, model, temperature, send_segment, max_tokens)
+        if not sent:
+            await self.send_text(header + "❌ LLM未返回回答")
+        return reply
+